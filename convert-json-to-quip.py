@@ -14,75 +14,194 @@ This creates the following directory structure for loading into Quip.
 """
 
 import argparse
-import csv
+import contextlib
+import functools
 import gzip
+import itertools
 import json
 from pathlib import Path
-from typing import Dict, Set, Union
+from typing import IO, Callable, Dict, Iterable, Iterator, List, Tuple, Union
 
+import ijson
+import numpy as np
 import openslide
-from shapely.geometry import Polygon
+
+# Faster gzip decompression, if available. rapidgzip decompresses in parallel, and
+# isal uses the SIMD-accelerated Intel ISA-L library. rapidgzip picks the number
+# of threads from the CPUs this process may run on.
+try:
+    import rapidgzip
+except ImportError:
+    rapidgzip = None
+try:
+    from isal import igzip
+except ImportError:
+    igzip = None
 
 PathType = Union[str, Path]
 
+# Predictions are buffered per nuclear type and written to the CSV in batches of this
+# size. Small batches are enough to amortize the NumPy calls, and keeping fewer
+# predictions alive at once makes garbage collection cheaper.
+_ROWS_PER_BATCH = 100
+# Features CSVs use the same line terminator as the csv module.
+_LINE_TERMINATOR = "\r\n"
+# Buffer size of the features CSVs. This is larger than the default of 8 KiB.
+_WRITE_BUFFER_SIZE = 1 << 20
 
-def _is_gzipped(path: PathType) -> bool:
-    with open(path, "rb") as f:
-        return f.read(2) == b"\x1f\x8b"
-
-
-def _nuc_prediction_to_quip_dict(d: Dict) -> Dict[str, Union[float, int, str]]:
-    area: float = Polygon(d["contour"]).area
-    # Converts [[0, 1], [2, 3]] to "0:1:2:3"
-    coords = ":".join(":".join(map(str, xy)) for xy in d["contour"])
-    coords = f"[{coords}]"
-    out: Dict[str, Union[float, int, str]] = {
-        "AreaInPixels": area,
-        "PhysicalSize": area,
-        "ClassId": d["type"],
-        "Polygon": coords,
-    }
-    return out
 
-
-def write_quip_features_csv(
-    hovernet_json: Dict,
-    output_path: PathType,
-    nuc_type: int = None,
-) -> None:
-    with open(output_path, "w", newline="") as csvfile:
-        fieldnames = ["AreaInPixels", "PhysicalSize", "ClassId", "Polygon"]
-        writer = csv.DictWriter(csvfile, fieldnames=fieldnames)
-        writer.writeheader()
-        prediction: Dict
-        for prediction in hovernet_json["nuc"].values():
-            # We take only the predictions of a particular type.
-            if nuc_type is not None:
-                if prediction["type"] == nuc_type:
-                    row = _nuc_prediction_to_quip_dict(prediction)
-                    writer.writerow(row)
-            else:
-                row = _nuc_prediction_to_quip_dict(prediction)
-                writer.writerow(row)
+def _open_gzip(fileobj: IO[bytes]) -> IO[bytes]:
+    if rapidgzip is not None:
+        return rapidgzip.open(fileobj, parallelization=0)
+    if igzip is not None:
+        return igzip.open(fileobj, "rb")
+    return gzip.open(fileobj, "rb")
 
 
-def write_quip_algmeta_json(
-    oslide: openslide.OpenSlide,
-    output_path: PathType,
-    out_file_prefix: str,
-    subject_id: str,
-    case_id: str,
-    analysis_id: str,
-    analysis_desc: str = None,
-) -> None:
-    image_width, image_height = oslide.dimensions
-    mppx = oslide.properties[openslide.PROPERTY_NAME_MPP_X]
-    mppy = oslide.properties[openslide.PROPERTY_NAME_MPP_Y]
+@contextlib.contextmanager
+def _open_input_json(path: PathType) -> Iterator[IO[bytes]]:
+    # The file is opened only once. We peek at its first bytes to check whether it is
+    # gzipped, and if so decompress from the same file object.
+    with open(path, "rb") as f:
+        if f.peek(2)[:2] == b"\x1f\x8b":
+            with _open_gzip(f) as gz:
+                yield gz
+        else:
+            yield f
+
+
+def _polygon_areas(xs: np.ndarray, ys: np.ndarray, offsets: np.ndarray) -> np.ndarray:
+    # Shoelace formula for many polygons at once. `xs` and `ys` hold the vertices of
+    # all polygons, and the vertices of polygon i are at offsets[i]:offsets[i + 1].
+    # Each vertex is paired with the next vertex of its own polygon. The last vertex
+    # of a polygon is paired with its first vertex.
+    starts, ends = offsets[:-1], offsets[1:]
+    areas = np.zeros(len(starts), dtype=np.float64)
+    # Empty contours have an area of 0. They are left out of the computation, because
+    # they would break the pairing of vertices and the sums over each polygon.
+    nonempty = ends > starts
+    starts, ends = starts[nonempty], ends[nonempty]
+    nxt = np.arange(1, len(xs) + 1)
+    nxt[ends - 1] = starts
+    # Products of pixel coordinates overflow int32, so compute them in int64. This
+    # keeps the areas exact.
+    xs = xs.astype(np.int64)
+    ys = ys.astype(np.int64)
+    cross = xs * ys[nxt] - ys * xs[nxt]
+    areas[nonempty] = 0.5 * np.abs(np.add.reduceat(cross, starts))
+    # Like shapely, treat contours with fewer than three vertices as having no area.
+    areas[offsets[1:] - offsets[:-1] < 3] = 0.0
+    return areas
+
+
+@functools.lru_cache(maxsize=None)
+def _quip_row_format(num_vertices: int) -> str:
+    # printf-style format of a features CSV row for a polygon with `num_vertices`
+    # vertices. The values are the formatted area (which is written as both
+    # AreaInPixels and PhysicalSize), the class ID, and the flattened coordinates, so
+    # that [[0, 1], [2, 3]] is written as "[0:1:2:3]". None of the fields need
+    # quoting: the numbers do not, and the polygon contains only digits, colons, and
+    # brackets.
+    coords = ":".join(["%d"] * (2 * num_vertices))
+    return f"%s,%s,%s,[{coords}]{_LINE_TERMINATOR}"
+
+
+def _nuc_predictions_to_quip_rows(predictions: List[Dict]) -> bytes:
+    contours = [d["contour"] for d in predictions]
+    lengths = [len(contour) for contour in contours]
+    offsets = np.zeros(len(contours) + 1, dtype=np.intp)
+    np.cumsum(lengths, out=offsets[1:])
+    # Converts [[[0, 1], [2, 3]], [[4, 5], ...]] to [0, 1, 2, 3, 4, 5, ...]
+    flat = list(itertools.chain.from_iterable(itertools.chain.from_iterable(contours)))
+    # HoVerNet contours are integer pixel coordinates, which fit in int32.
+    xy = np.array(flat, dtype=np.int32)
+    areas: List[float] = _polygon_areas(xy[0::2], xy[1::2], offsets).tolist()
+    # PhysicalSize is the same as AreaInPixels, so each area is formatted only once.
+    area_strs = list(map(repr, areas))
+
+    # The rows of the whole batch are formatted with a single printf-style call. This
+    # writes every number directly into the output string, without making a string
+    # object for each coordinate.
+    fmt = "".join([_quip_row_format(n) for n in lengths])
+    values: List[Union[int, str]] = []
+    bounds = (2 * offsets).tolist()
+    for area_str, d, start, end in zip(area_strs, predictions, bounds, bounds[1:]):
+        # A null type is written as an empty field, as the csv module did.
+        class_id = "" if d["type"] is None else d["type"]
+        values += (area_str, area_str, class_id)
+        values += flat[start:end]
+    return (fmt % tuple(values)).encode("ascii")
+
+
+def _iter_batches(predictions: Iterable[Dict]) -> Iterator[Tuple[int, List[Dict]]]:
+    # Group predictions by nuclear type into batches of at most _ROWS_PER_BATCH. Yields
+    # (nuc_type, batch) pairs. Batches of one type are yielded in the order of their
+    # predictions.
+    batches: Dict[int, List[Dict]] = {}
+    prediction: Dict
+    for prediction in predictions:
+        nuc_type: int = prediction["type"]
+        batch = batches.setdefault(nuc_type, [])
+        batch.append(prediction)
+        if len(batch) >= _ROWS_PER_BATCH:
+            yield nuc_type, batch
+            batches[nuc_type] = []
+    # Yield whatever is left over in each batch.
+    for nuc_type, batch in batches.items():
+        if batch:
+            yield nuc_type, batch
+
+
+def write_quip_features_csvs(
+    predictions: Iterable[Dict],
+    output_path_fn: Callable[[int], PathType],
+) -> Dict[int, int]:
+    # Route each prediction to the CSV of its nuclear type in a single pass. The CSV
+    # for a type is opened (at `output_path_fn(nuc_type)`) the first time that type is
+    # seen. Returns the number of predictions written for each type.
+    #
+    # Predictions are converted to rows a batch at a time, so that the areas of a
+    # batch are computed together. The CSVs are written in binary mode. Every field is
+    # ASCII, so each batch of rows is encoded once and we skip the text layer.
+    header = "AreaInPixels,PhysicalSize,ClassId,Polygon" + _LINE_TERMINATOR
+    csvfiles: Dict[int, IO[bytes]] = {}
+    counts: Dict[int, int] = {}
+    with contextlib.ExitStack() as stack:
+        for nuc_type, batch in _iter_batches(predictions):
+            csvfile = csvfiles.get(nuc_type)
+            if csvfile is None:
+                csvfile = stack.enter_context(
+                    open(output_path_fn(nuc_type), "wb", buffering=_WRITE_BUFFER_SIZE)
+                )
+                csvfile.write(header.encode("ascii"))
+                csvfiles[nuc_type] = csvfile
+                counts[nuc_type] = 0
+            csvfile.write(_nuc_predictions_to_quip_rows(batch))
+            counts[nuc_type] += len(batch)
+    return counts
+
+
+def _read_slide_properties(path: PathType) -> Tuple[int, int, str]:
+    # Returns the width, height, and microns per pixel of the slide.
+    with openslide.OpenSlide(str(path)) as oslide:
+        image_width, image_height = oslide.dimensions
+        mppx = oslide.properties[openslide.PROPERTY_NAME_MPP_X]
+        mppy = oslide.properties[openslide.PROPERTY_NAME_MPP_Y]
     if mppx != mppy:
         raise ValueError(f"mppx not equal to mppy: {mppx} != {mppy}")
+    return image_width, image_height, mppx
+
+
+def _make_common_algmeta(
+    image_width: int,
+    image_height: int,
+    mpp: str,
+) -> Dict:
+    # The parts of the algmeta JSON that depend only on the slide, so they are the
+    # same for every nuclear type.
     # Because these predictions apply to the entire whole slide image, we set the tile
     # size equal to the image size. Think of the image as one big tile.
-    meta_json = {
+    return {
         "input_type": "wsi",
         "otsu_ratio": 0.0,
         "curvature_weight": 0.0,
@@ -93,7 +212,7 @@ def write_quip_algmeta_json(
         "ms_kernel": 0,
         "declump_type": 0,
         "levelset_num_iters": 0,
-        "mpp": mppx,
+        "mpp": mpp,
         "image_width": image_width,
         "image_height": image_height,
         "tile_minx": 0,
@@ -105,6 +224,20 @@ def write_quip_algmeta_json(
         "patch_width": image_width,
         "patch_height": image_height,
         "output_level": "mask",
+    }
+
+
+def write_quip_algmeta_json(
+    common_algmeta: Dict,
+    output_path: PathType,
+    out_file_prefix: str,
+    subject_id: str,
+    case_id: str,
+    analysis_id: str,
+    analysis_desc: str = None,
+) -> None:
+    meta_json = {
+        **common_algmeta,
         # This is the prefix of the features and algmeta files.
         # The two files are {out_file_prefix}-features.csv and
         # {out_file_prefix}-algmeta.json
@@ -165,19 +298,10 @@ def get_parsed_args(args=None) -> TypedNameSpace:
 def main(args=None) -> None:
     args = get_parsed_args(args)
 
-    print(f"Reading input JSON file {args.input_json}")
-    open_fn = gzip.open if _is_gzipped(args.input_json) else open
-    with open_fn(args.input_json) as f:  # type: ignore
-        hovernet_json = json.load(f)
-    print(f"Found {len(hovernet_json['nuc']):,} predicted polygons")
-
-    # Figure out the possible predicted classes. We need to make a CSV+JSON pair for
-    # each class.
-    nuc_types: Set[int] = {d["type"] for d in hovernet_json["nuc"].values()}
-    print(f"Found {len(nuc_types)} predicted classes: {nuc_types}")
-
+    # The slide properties are read once for all classes, and before any output is
+    # written, so that a bad slide fails early.
     print(f"Opening slide: {args.slide}")
-    oslide = openslide.OpenSlide(str(args.slide))
+    image_width, image_height, mpp = _read_slide_properties(args.slide)
 
     # Create directory tree.
     out_root = Path(args.analysis_id)
@@ -187,32 +311,55 @@ def main(args=None) -> None:
         print("[WARNING] potentially overwriting files")
     out_second.mkdir(parents=True, exist_ok=True)
 
-    print("-" * 40)
-    for nuc_type in nuc_types:
-        print(f"Working on nuclear prediction type {nuc_type}")
+    # We do not know the predicted classes until we have seen them, so the output
+    # directory for each class is made when its first prediction is streamed in.
+    def get_features_path(nuc_type: int) -> Path:
+        print(f"Found nuclear prediction type {nuc_type}")
         out_dir = out_second / f"type{nuc_type}"
         if out_dir.exists():
             print(f"[WARNING] output directory exists: {out_dir}")
             print("[WARNING] potentially overwriting files")
         out_dir.mkdir(exist_ok=True)
-        print(f"Saving outputs to {out_dir}")
-
-        out_file_prefix = f"{args.analysis_id}-type{nuc_type}"
-
-        # Create features CSV.
-        features_file = out_dir / f"{out_file_prefix}-features.csv"
+        features_file = out_dir / f"{args.analysis_id}-type{nuc_type}-features.csv"
         print(f"Writing features to {features_file}")
-        write_quip_features_csv(
-            hovernet_json=hovernet_json,
-            output_path=features_file,
-            nuc_type=nuc_type,
+        return features_file
+
+    print("-" * 40)
+    print(f"Streaming predictions from input JSON file {args.input_json}")
+    with _open_input_json(args.input_json) as f:
+        # ijson uses its fastest available backend (yajl2_c if compiled). We parse
+        # non-integer numbers (e.g., type_prob) as floats instead of Decimals, which
+        # are much slower to construct.
+        items = ijson.kvitems(f, "nuc", use_float=True)
+        predictions = (prediction for _, prediction in items)
+        counts = write_quip_features_csvs(
+            predictions=predictions,
+            output_path_fn=get_features_path,
         )
+    print(f"Found {sum(counts.values()):,} predicted polygons")
+
+    # We need to make a CSV+JSON pair for each class.
+    # HoVerNet sets the type to None when it is run without a type branch.
+    nuc_types = sorted(counts, key=lambda t: (t is None, t))
+    print(f"Found {len(nuc_types)} predicted classes: {nuc_types}")
+
+    common_algmeta = _make_common_algmeta(
+        image_width=image_width,
+        image_height=image_height,
+        mpp=mpp,
+    )
+
+    print("-" * 40)
+    for nuc_type in nuc_types:
+        print(f"Working on nuclear prediction type {nuc_type}")
+        out_dir = out_second / f"type{nuc_type}"
+        out_file_prefix = f"{args.analysis_id}-type{nuc_type}"
 
         # Create algmeta JSON.
         algmeta_file = out_dir / f"{out_file_prefix}-algmeta.json"
         print(f"Writing algmeta to {algmeta_file}")
         write_quip_algmeta_json(
-            oslide=oslide,
+            common_algmeta=common_algmeta,
             output_path=algmeta_file,
             out_file_prefix=out_file_prefix,
             subject_id=args.subject_id,
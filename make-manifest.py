@@ -3,6 +3,7 @@
 directory made by `convert-json-to-quip.py`."""
 
 import argparse
+import os
 from pathlib import Path
 import sys
 
@@ -38,33 +39,51 @@ def main(args=None):
         + "-"
         + paad_manifest.loc[:, "imageid"]
     )
+    # Rows with a missing subject or image ID can never match a directory. Drop them,
+    # so that they do not make the index non-unique.
+    paad_manifest = paad_manifest[paad_manifest.index.notna()]
+    duplicated = set(paad_manifest.index[paad_manifest.index.duplicated()])
+    # Look up rows in a dict, which is much faster than .loc for single keys.
+    paad_lookup = dict(zip(paad_manifest.index, paad_manifest.to_dict("records")))
 
     # All of these are unique, because they are directory names.
-    all_subjid_caseid = [p.name for p in args.input.glob("*") if p.is_dir()]
+    # os.scandir gets the file type from the directory listing, so checking whether an
+    # entry is a directory does not need a stat call.
+    with os.scandir(args.input) as entries:
+        all_subjid_caseid = [entry.name for entry in entries if entry.is_dir()]
     print(f"Found {len(all_subjid_caseid)} subject-case pairs")
-    rows = []
+    # Paths are built as plain strings, which is all the output CSV needs.
+    input_dir = str(args.input)
+    frames = []
     for subjid_caseid in all_subjid_caseid:
         print(f"Working on {subjid_caseid} ...")
-        paths_for_this_sample = (args.input / subjid_caseid).glob("*")
-
-        try:
-            paad_row = paad_manifest.loc[subjid_caseid]
-        except KeyError:
+        paad_row = paad_lookup.get(subjid_caseid)
+        if paad_row is None:
             print(f"[WARNING] manifest does not contain {subjid_caseid}")
             print("[WARNING] skipping...")
             continue
+        if subjid_caseid in duplicated:
+            print(f"[WARNING] manifest has more than one row for {subjid_caseid}")
+            print("[WARNING] skipping...")
+            continue
+
+        sample_dir = os.path.join(input_dir, subjid_caseid)
+        paths_for_this_sample = [
+            sample_dir + os.sep + name for name in os.listdir(sample_dir)
+        ]
+        if not paths_for_this_sample:
+            continue
         for path in paths_for_this_sample:
             print(f"  {path}")
-            tmp_row = paad_row.copy()
-            tmp_row["path"] = path
-            rows.append(tmp_row)
+        # The manifest values are repeated once per path.
+        frames.append(pd.DataFrame({**paad_row, "path": paths_for_this_sample}))
 
-    if not rows:
+    if not frames:
         print("No rows found... exiting")
         sys.exit(1)
 
     print(f"Writing manifest to {args.output}")
-    out_df = pd.DataFrame(rows)
+    out_df = pd.concat(frames, ignore_index=True)
     out_df.to_csv(args.output, index=False)
 
 